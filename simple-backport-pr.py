@@ -13,39 +13,230 @@ Options:
   --ignore-commit-not-merged
   --ignore-order-commit-shas-non-equal
   --ignore-tracker
+  --force                    Re-check not-backported commits even if recently checked
+  --jobs=jobs                Concurrent fetch/check workers [default: 8]
   --label=label              GH labels
+  --paranoid                 Also match backports by commit title, not only
+                             by sha and patch-id
   -h --help                  Show this screen.
 """
-import json
-from datetime import datetime
-from subprocess import check_call, check_output, CalledProcessError
+from __future__ import annotations
+
+import atexit
+import functools
+import itertools
+import re
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from subprocess import check_call, check_output, run, CalledProcessError, CompletedProcess, DEVNULL
 import os
 import sys
-from typing import List, Tuple, NamedTuple, Dict, Optional, OrderedDict
-
+from typing import FrozenSet, List, Tuple, Dict, Optional, OrderedDict, TYPE_CHECKING
+
+try:
+    import orjson
+except ImportError:
+    # same interface, compact separators; several times slower than orjson
+    import json as _json
+
+    class orjson:  # type: ignore
+        @staticmethod
+        def dumps(obj) -> bytes:
+            def _default(o):
+                if isinstance(o, datetime):
+                    return o.isoformat()
+                raise TypeError(f'cannot serialize {type(o)}')
+            return _json.dumps(obj, separators=(',', ':'), default=_default).encode()
+
+        @staticmethod
+        def loads(data):
+            return _json.loads(data)
+
+import requests
+from urllib3.util.retry import Retry
 from dateutil import parser
-from github import Github
-from github.Repository import Repository
-from github.PullRequest import PullRequest
-from github.PaginatedList import PaginatedList
-from github.Commit import Commit
-from github.Milestone import Milestone
 import docopt
 
+if TYPE_CHECKING:
+    # PyGithub drags in jwt/cryptography (~hundreds of ms); it is imported
+    # lazily in __main__ so --help and argv errors never pay for it
+    from github import Github
+    from github.Repository import Repository
+    from github.PullRequest import PullRequest
+
 check_pr_not_merged = 'pr-not-merged'
 check_tracker = 'tracker'
 commit_not_merged = 'commit-not-merged'
 order_commit_shas_non_equal = 'order-commit-shas-non-equal'
 
+# how long a "not backported" verdict is trusted before git is asked again
+_recheck_ttl = 3600
+_force_recheck = False
+# the sha set and the patch-id map already catch cherry-picks; the title
+# probes only add fuzzy matching on top, so they are opt-in
+_paranoid = False
+
+def _git(*args: str, capture: bool = False) -> CompletedProcess:
+    return run(('git',) + args, check=True, capture_output=capture, text=True)
+
+
+@functools.lru_cache(maxsize=1)
 def get_current_branch_name() -> str:
-    current_branch = check_output('git symbolic-ref --short HEAD', shell=True).decode().strip()
-    return current_branch
+    # .git/HEAD holds 'ref: refs/heads/<branch>': reading it directly saves
+    # a fork per invocation. Worktrees (where .git is a file) and detached
+    # HEADs fall back to rev-parse.
+    try:
+        head = Path('.git/HEAD').read_text().strip()
+        if head.startswith('ref: refs/heads/'):
+            return head[len('ref: refs/heads/'):]
+    except OSError:
+        pass
+    return _git('rev-parse', '--abbrev-ref', 'HEAD', capture=True).stdout.strip()
 
 base_branch_name = get_current_branch_name()
 
+@functools.lru_cache(maxsize=1)
+def _base_branch_shas() -> FrozenSet[str]:
+    # one full rev-list instead of one `git branch --contains` walk per commit
+    try:
+        out = check_output(['git', 'rev-list', base_branch_name], text=True)
+    except CalledProcessError:
+        print(
+            'maybe helps: $ git checkout master && git pull upstream master && git checkout -')
+        raise
+    return frozenset(out.split())
+
+
+@functools.lru_cache(maxsize=1)
+def _cherry_map() -> Dict[str, bool]:
+    """sha of a master commit -> equivalent patch already in the base branch.
+
+    ``git cherry`` compares patch-ids, so it also recognizes cherry-picked
+    commits whose sha changed - the case the title greps only approximate.
+    """
+    try:
+        out = _git('cherry', f'upstream/{base_branch_name}', 'master', capture=True).stdout
+    except CalledProcessError:
+        # no upstream remote or branch here: leave it to the log greps
+        return {}
+    ret: Dict[str, bool] = {}
+    for line in out.splitlines():
+        mark, _, sha = line.partition(' ')
+        ret[sha] = mark == '-'
+    return ret
+
+
+def _warm_git_caches():
+    # run the batched scans up front so the first commit of the loop does
+    # not pay for them; afterwards the per-commit work is pure dict lookups.
+    # rev-list and cherry are independent subprocess waits, so overlap them
+    _ensure_commit_graph()
+    for f in [_executor().submit(_base_branch_shas), _executor().submit(_cherry_map)]:
+        f.result()
+
+
+_cg_written = False
+
+
+def _ensure_commit_graph():
+    # speeds up the rev-list and log walks below; purely an optimization,
+    # so never abort the run over it (old git without --changed-paths,
+    # read-only repo, ...)
+    global _cg_written
+    if _cg_written:
+        return
+    try:
+        check_call(['git', 'commit-graph', 'write', '--reachable', '--changed-paths'],
+                   stderr=DEVNULL)
+    except CalledProcessError:
+        pass
+    _cg_written = True
+
+
+# truncate a commit title at the first character git would treat as a
+# glob/grep metacharacter
+_TITLE_STOP = re.compile(r'[\[\]*?]')
+
+
+def _sanitize_title(title: str) -> str:
+    return _TITLE_STOP.split(title, maxsplit=1)[0]
+
+
+class GitLogIndex:
+    """One combined ``git log --grep`` scan shared by a whole backport/crunch run.
+
+    Answers "does some commit in the current branch mention this sha or title?"
+    without forking git once per commit: all patterns go into a single
+    invocation (multiple ``--grep`` arguments are ORed) and the few matching
+    commits are kept in memory for lookup.
+    """
+
+    def __init__(self, patterns: List[str]):
+        self._records: List[Tuple[str, str]] = []
+        # subject -> sha from one plain revwalk: exact-title hits are O(1)
+        # dict lookups, and anything found here can be dropped from the much
+        # more expensive --grep pass below
+        self._subjects: Dict[str, str] = {}
+        out = check_output(['git', 'log', '--no-merges', '--format=%H%x1f%s'],
+                           text=True)
+        for line in out.splitlines():
+            sha, _, subject = line.partition('\x1f')
+            self._subjects.setdefault(subject, sha)
+        patterns = sorted({p for p in patterns if p and p not in self._subjects})
+        if not patterns:
+            return
+        cmd = ['git', 'log', '--no-merges', '-E', '--format=%H%x1f%B%x00']
+        cmd += ['--grep=' + re.escape(p) for p in patterns]
+        for record in check_output(cmd, text=True).split('\x00'):
+            record = record.strip()
+            if not record:
+                continue
+            sha, _, message = record.partition('\x1f')
+            self._records.append((sha, message))
+
+    def find(self, pattern: str) -> Optional[str]:
+        sha = self._subjects.get(pattern)
+        if sha is not None:
+            return f'{sha} {pattern}'
+        for sha, message in self._records:
+            if pattern in message:
+                return f'{sha} {message.splitlines()[0]}'
+        return None
+
+
+_log_index: Optional[GitLogIndex] = None
+
+
+def _build_log_index(prs: List["CachedPr"]) -> GitLogIndex:
+    patterns = []
+    for pr in prs:
+        for sha in pr._cached_commit_shas() or []:
+            patterns.append(sha)
+            d = gh_cache.commits.get(sha)
+            if _paranoid and d is not None:
+                patterns.append(_sanitize_title(d['message'].split('\n')[0]))
+    return GitLogIndex(patterns)
+
+
 default_labels = 'cephadm orchestrator'.split()
+# labels worth carrying over onto a backport PR
+interesting_labels = 'cephadm orchestrator rook mgr documentation'.split()
 labels: List[str] = []
 
+_jobs = 8
+
+
+@functools.lru_cache(maxsize=1)
+def _executor() -> ThreadPoolExecutor:
+    # shared pool for per-commit git checks; the subprocess wait releases
+    # the GIL. Created on first use so --jobs can size it.
+    return ThreadPoolExecutor(max_workers=_jobs)
+
 
 class GHCache:
     @staticmethod
@@ -59,110 +250,178 @@ class GHCache:
         return ret
 
     def __init__(self):
+        self._lock = threading.Lock()
+        self._defer = 0
+        self._pending: List[bytes] = []
+        atexit.register(self._compact)
+
+    @functools.cached_property
+    def _content(self) -> dict:
+        # loaded on first access: subcommands that never touch the PR cache
+        # skip parsing a potentially multi-MB snapshot entirely
         try:
-            with open(self._fname()) as f:
-                self._content: dict = json.load(f)
+            with open(self._fname(), 'rb') as f:
+                content: dict = orjson.loads(f.read())
         except FileNotFoundError:
-            self._content = {}
-
-        self.pull_instances: Dict[int, PullRequest] = {}
+            content = {}
+        self._replay_wal(content)
+        for key in ('prs', 'commits', 'pr_commits'):
+            content.setdefault(key, {})
+        return content
 
-
-    @property
+    @functools.cached_property
     def prs(self) -> Dict[str, dict]:
-        if 'prs' not in self._content:
-            self._content['prs'] = {}
-
         return self._content['prs']
 
-    @property
+    @functools.cached_property
     def commits(self) -> Dict[str, dict]:
-        if 'commits' not in self._content:
-            self._content['commits'] = {}
-
         return self._content['commits']
 
-    @property
+    @functools.cached_property
     def pr_commits(self) -> Dict[str, List[str]]:
-        if 'pr_commits' not in self._content:
-            self._content['pr_commits'] = {}
-
         return self._content['pr_commits']
 
+    @functools.cached_property
+    def _wal(self):
+        return open(self._wal_fname(), 'ab')
+
+    def _wal_fname(self):
+        return self._fname() + '.wal'
+
+    def _replay_wal(self, content: dict):
+        # deltas of a previous run that were never compacted into the snapshot
+        try:
+            with open(self._wal_fname(), 'rb') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    delta = orjson.loads(line)
+                    content.setdefault(delta['k'], {})[delta['id']] = delta['v']
+        except FileNotFoundError:
+            pass
+
+    def save_delta(self, kind: str, key: str, value):
+        # O(1) bytes appended per mutation instead of rewriting the whole file
+        with self._lock:
+            self._pending.append(orjson.dumps({'k': kind, 'id': key, 'v': value}) + b'\n')
+        if self._defer == 0:
+            self._flush_deltas()
+
+    def _flush_deltas(self):
+        with self._lock:
+            if self._pending:
+                self._wal.writelines(self._pending)
+                self._wal.flush()
+                self._pending.clear()
+
+    @contextmanager
+    def batched(self):
+        """Defer the WAL writes of every save() in the block to one flush."""
+        self._defer += 1
+        try:
+            yield
+        finally:
+            self._defer -= 1
+            if self._defer == 0:
+                self._flush_deltas()
+
+    def _compact(self):
+        if '_content' not in self.__dict__:
+            # cache never loaded, so nothing changed: keep snapshot and WAL
+            return
+        with self._lock:
+            # the snapshot below covers anything still pending
+            self._pending.clear()
+        self.save()
+        self._wal.seek(0)
+        self._wal.truncate()
+
 
     def save(self):
         try:
-            c = json.dumps(self._content)
+            c = orjson.dumps(self._content)
         except:
             print(self._content)
             raise
 
         # takes ages to fill the cache. make sure it's not getting corrupted
-        with open(self._fname() + '.tmp', 'w') as f:
-            f.write(c)
-            f.flush()
-            os.fsync(f.fileno())
+        with self._lock:
+            with open(self._fname() + '.tmp', 'wb') as f:
+                f.write(c)
+                f.flush()
+                os.fsync(f.fileno())
 
-        os.rename(self._fname() + '.tmp', self._fname())
+            os.replace(self._fname() + '.tmp', self._fname())
 
 
-class CachedCommit(NamedTuple):
+@dataclass(slots=True, frozen=True)
+class CachedCommit:
     sha: str
     message: str
     backported: bool
 
-    @classmethod
-    def from_gh(cls, gh: Commit) -> "CachedCommit":
-        tmp = cls(gh.sha, gh.commit.message, False)
-
-        r = cls(gh.sha, gh.commit.message, tmp._in_current_branch())
-        r.save()
-        return r
-
     @classmethod
     def from_cache(cls, sha) -> "CachedCommit":
-        d = gh_cache.commits[sha].copy()
-        if 'backported' not in d or not d['backported']:
-            d['backported'] = False
-            tmp = cls(**d)
-            d['backported'] = tmp._in_current_branch()
-        return cls(**d)
+        d = gh_cache.commits[sha]
+        backported = d.get('backported', False)
+        if not backported:
+            # commits never become un-backported, so a recent False verdict
+            # can be trusted without walking git again
+            if not _force_recheck and time.time() - d.get('last_checked', 0) < _recheck_ttl:
+                return cls(d['sha'], d['message'], False)
+            r = cls(d['sha'], d['message'],
+                    cls(d['sha'], d['message'], False)._in_current_branch())
+            r.save()
+            return r
+        return cls(d['sha'], d['message'], backported)
 
     def save(self):
-        gh_cache.commits[self.sha] = self._asdict().copy()
-        gh_cache.save()
+        d = {
+            'sha': self.sha,
+            'message': self.message,
+            'backported': self.backported,
+            'last_checked': time.time(),
+        }
+        gh_cache.commits[self.sha] = d
+        gh_cache.save_delta('commits', self.sha, d)
+
+    def _in_current_branch(self, index: Optional[GitLogIndex] = None):
+        # reachability: the rev-list set contains exactly the ancestors of the
+        # base branch, so no per-commit merge-base call is needed on top
+        if self.sha in _base_branch_shas():
+            return True
 
-    def _in_current_branch(self):
-        try:
-            in_branches = [
-                b.decode().replace('*', '').strip() for b in
-                check_output(f'git branch --contains {self.sha}', shell=True).splitlines()
-            ]
-        except CalledProcessError:
-            print(
-                'maybe helps: $ git checkout master && git pull upstream master && git checkout -')
-            raise
-        #print(f'already in branches {in_branches}')
-        if base_branch_name in in_branches:
+        # only trust a positive patch-id verdict: a cherry-pick resolved with
+        # conflicts has a different patch-id ('+'), yet its -x trailer still
+        # names this sha, so the log greps below must get their shot
+        if _cherry_map().get(self.sha):
             return True
 
         msg = self.message
         orig_title = msg.split('\n')[0]
-        title = orig_title
-        for c in '[]*?':
-            title = title.split(c)[0]
-
-        out = check_output(["git", "log", "--no-merges", "--grep", self.sha, "--oneline"]).strip()
-        if out:
-            if not _check_silent:
-                print(f"Commit likely already in current branch:\n  {out.decode()}")
-            return True
-
-        out = check_output(["git", "log", "--no-merges", "--grep", title, "--oneline"]).strip()
-        if out:
-            if not _check_silent:
-                print(f"Commit likely already in current branch:\n  {out.decode()}")
-            return True
+        title = _sanitize_title(orig_title)
+        patterns = (self.sha, title) if _paranoid else (self.sha,)
+
+        index = index if index is not None else _log_index
+        if index is not None:
+            for pattern in patterns:
+                hit = index.find(pattern)
+                if hit:
+                    if not _check_silent:
+                        print(f"Commit likely already in current branch:\n  {hit}")
+                    return True
+            return False
+
+        for pattern in patterns:
+            # -n 1: we only need to know whether there is a hit, so stop at
+            # the first one instead of buffering the whole matching log
+            out = _git('log', '--no-merges', '-n', '1', '--grep', pattern,
+                       '--format=%H %s', capture=True).stdout.strip()
+            if out:
+                if not _check_silent:
+                    print(f"Commit likely already in current branch:\n  {out}")
+                return True
         return False
 
     def validate(self):
@@ -171,7 +430,17 @@ class CachedCommit(NamedTuple):
                f'looks like {self} contains a link to the tracker')
 
 
-class CachedPr(NamedTuple):
+def _utc_naive(dt: datetime) -> datetime:
+    # merged_at is compared and sorted against naive UTC datetimes
+    # (earliest_pr cutoff, 1970 fallback); GraphQL and newer PyGithub hand
+    # back tz-aware values, so normalize at every ingestion point
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+@dataclass(slots=True, frozen=True)
+class CachedPr:
     number: int
     commits: int
     title: str
@@ -180,6 +449,8 @@ class CachedPr(NamedTuple):
     merged_at: datetime
     html_url: str
     backported: bool
+    labels: Tuple[str, ...] = ()
+    merge_commit_sha: str = ''
 
     @classmethod
     def from_gh_pr(cls, gh: PullRequest) -> "CachedPr":
@@ -188,23 +459,33 @@ class CachedPr(NamedTuple):
                 gh.title,
                 gh.body,
                 gh.merged,
-                gh.merged_at,
+                _utc_naive(gh.merged_at) if gh.merged_at else datetime(1970, 1, 1),
                 gh.html_url,
-                False)
-        gh_cache.pull_instances[r.number] = gh
+                False,
+                tuple(l.name for l in gh.labels),
+                gh.merge_commit_sha or '')
         r.save()
         return r
 
 
     @classmethod
     def from_cache(cls, number: int) -> "CachedPr":
-        d = gh_cache.prs[str(number)].copy()
-        d['merged_at'] = parser.isoparse(d['merged_at'])
-        if 'html_url' not in d:
-            d['html_url'] = ''
-        if 'backported' not in d:
-            d['backported'] = False
-        return cls(**d)
+        d = gh_cache.prs[str(number)]
+        merged_at = d['merged_at']
+        if isinstance(merged_at, str):
+            merged_at = parser.isoparse(merged_at)
+        # entries written before the normalization may carry an offset
+        merged_at = _utc_naive(merged_at)
+        return cls(d['number'],
+                   d['commits'],
+                   d['title'],
+                   d['body'],
+                   d['merged'],
+                   merged_at,
+                   d.get('html_url', ''),
+                   d.get('backported', False),
+                   tuple(d.get('labels', ())),
+                   d.get('merge_commit_sha', ''))
 
     @classmethod
     def from_any(cls, number: int):
@@ -213,50 +494,114 @@ class CachedPr(NamedTuple):
         except KeyError:
             return cls.from_gh_pr(ceph_repo().get_pull(number))
 
-    def save(self):
-        d = self._asdict().copy()
+    @classmethod
+    def bulk_fetch(cls, numbers: List[int]):
+        """Hydrate every uncached PR (and its commits) in one GraphQL query.
+
+        PRs that are cached but lack a commit list (entries from before the
+        commit batch existed) are re-fetched too, so crunch/backport do not
+        fall back to one REST round-trip per PR for them. from_any()
+        afterwards reads from the cache; its REST path only fires for PRs
+        the batch could not return.
+        """
+        missing = []
+        for n in numbers:
+            if str(n) not in gh_cache.prs:
+                missing.append(n)
+            elif cls.from_cache(n)._cached_commit_shas() is None:
+                missing.append(n)
+        gh_graphql_fetch(missing)
 
+    def save(self):
+        backported = self.backported
         if str(self.number) in gh_cache.prs:
-            d['backported'] = d['backported'] or self.from_cache(self.number).backported
-
-        d['merged_at'] = self.merged_at.isoformat()
+            backported = backported or self.from_cache(self.number).backported
+
+        # orjson serializes the datetime itself, no isoformat() round-trip;
+        # tuples it does not, so the labels become a list
+        d = {
+            'number': self.number,
+            'commits': self.commits,
+            'title': self.title,
+            'body': self.body,
+            'merged': self.merged,
+            'merged_at': self.merged_at,
+            'html_url': self.html_url,
+            'backported': backported,
+            'labels': list(self.labels),
+            'merge_commit_sha': self.merge_commit_sha,
+        }
         gh_cache.prs[str(self.number)] = d
-        gh_cache.save()
+        gh_cache.save_delta('prs', str(self.number), d)
+
+    def _cached_commit_shas(self) -> Optional[List[str]]:
+        # merged PRs are immutable, so their merge sha is a key that never
+        # needs invalidating; older cache entries are keyed by PR number
+        shas = None
+        if self.merge_commit_sha:
+            shas = gh_cache.pr_commits.get(self.merge_commit_sha)
+        if shas is None:
+            shas = gh_cache.pr_commits.get(str(self.number))
+        return shas
 
     def get_commits(self) -> List[CachedCommit]:
-        if str(self.number) in gh_cache.pr_commits:
-            return [
-                CachedCommit.from_cache(sha)
-                for sha in gh_cache.pr_commits[str(self.number)]
-            ]
+        cached = self._cached_commit_shas()
+        if cached is not None:
+            return [CachedCommit.from_cache(sha) for sha in cached]
+        # plain REST GETs: the commit list endpoint returns the messages
+        # inline, unlike PyGithub whose commit.commit access re-fetches each
+        # commit behind the attribute lookup. One page covers almost every
+        # PR, but keep paging so >100-commit PRs are not silently truncated.
+        pairs = []
+        page = 1
+        while True:
+            resp = _rest_get(f'/repos/ceph/ceph/pulls/{self.number}/commits'
+                             f'?per_page=100&page={page}')
+            batch = resp.json()
+            pairs += [(c['sha'], c['commit']['message']) for c in batch]
+            if len(batch) < 100:
+                break
+            page += 1
+        # the in-branch checks are independent subprocess waits: overlap them
+        flags = _executor().map(
+            lambda p: CachedCommit(p[0], p[1], False)._in_current_branch(),
+            pairs)
         ret = [
-                CachedCommit.from_gh(c) for c in self.github.get_commits()
-            ]
-        gh_cache.pr_commits[str(self.number)] = [cc.sha for cc in ret]
-        gh_cache.save()
-
-        for c in ret:
-            c.validate()
+            CachedCommit(sha, message, flag)
+            for (sha, message), flag in zip(pairs, flags)
+        ]
+        shas = []
+        for cc in ret:
+            cc.save()
+            cc.validate()
+            shas.append(cc.sha)
+        key = self.merge_commit_sha or str(self.number)
+        gh_cache.pr_commits[key] = shas
+        gh_cache.save_delta('pr_commits', key, shas)
 
         return ret
 
     def get_backported(self) -> bool:
         if self.backported:
             return True
-        b = all(c.backported for c in self.get_commits())
+        shas = self._cached_commit_shas()
+        if shas is not None and all(sha in gh_cache.commits for sha in shas):
+            # walk the cached shas and stop at the first one that is not
+            # backported, without materializing CachedCommits for the rest
+            b = True
+            for sha in shas:
+                if gh_cache.commits[sha].get('backported'):
+                    continue
+                if not CachedCommit.from_cache(sha).backported:
+                    b = False
+                    break
+        else:
+            b = all(c.backported for c in self.get_commits())
         if b:
-            copy = self._replace(backported=True)
+            copy = replace(self, backported=True)
             copy.save()
         return b
 
-
-    @property
-    def github(self) -> PullRequest:
-        if self.number in gh_cache.pull_instances:
-            return gh_cache.pull_instances[self.number]
-        gh_cache.pull_instances[self.number] = ceph_repo().get_pull(self.number)
-        return gh_cache.pull_instances[self.number]
-
     def validate(self):
         _check(not self.merged,
                check_pr_not_merged,
@@ -267,8 +612,133 @@ class CachedPr(NamedTuple):
                    f'looks like pr contains a link to the tracker {self.html_url}')
 
     def get_labels(self):
-        labels = [l.name for l in self.github.labels]
-        return [l for l in 'cephadm orchestrator rook mgr documentation'.split() if l in labels]
+        # filled from the GraphQL batch / cache: no extra REST call per PR
+        return [l for l in interesting_labels if l in self.labels]
+
+@functools.lru_cache(maxsize=1)
+def _session() -> requests.Session:
+    # one pooled session: keep-alive amortizes the TLS handshake across all
+    # GraphQL and REST calls of a run
+    s = requests.Session()
+    s.headers['Authorization'] = f'bearer {token}'
+    # allowed_methods=None also retries the GraphQL POSTs and the issue
+    # PATCH; both are safe to replay
+    retry = Retry(total=5, backoff_factor=1, status_forcelist=[502, 503, 504],
+                  allowed_methods=None, respect_retry_after_header=True)
+    s.mount('https://', requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=max(_jobs, 8), max_retries=retry))
+    return s
+
+
+def _rest_get(path: str) -> requests.Response:
+    resp = _session().get('https://api.github.com' + path)
+    resp.raise_for_status()
+    return resp
+
+
+def _graphql_post(payload: dict) -> requests.Response:
+    """POST to the GraphQL endpoint, sleeping through rate limits.
+
+    On an exhausted quota this waits until X-RateLimit-Reset instead of
+    crashing mid-run; 403s without a rate-limit signature (permissions,
+    SAML enforcement) get a few exponential-backoff retries and then the
+    error is raised instead of looping forever.
+    """
+    backoff = 2
+    attempts = 0
+    while True:
+        resp = _session().post('https://api.github.com/graphql', json=payload)
+        if resp.status_code in (403, 429):
+            retry_after = resp.headers.get('Retry-After')
+            if retry_after is not None:
+                delay = int(retry_after)
+            elif resp.headers.get('X-RateLimit-Remaining') == '0':
+                reset = int(resp.headers.get('X-RateLimit-Reset', '0'))
+                delay = max(reset - time.time(), 0) + 1
+            else:
+                # no rate-limit signature: likely a permissions 403 that
+                # will never succeed, so give up after a few tries
+                attempts += 1
+                if attempts >= 5:
+                    resp.raise_for_status()
+                delay = backoff
+                backoff = min(backoff * 2, 60)
+            print(f'rate limited by GitHub; sleeping {delay:.0f}s')
+            time.sleep(delay)
+            continue
+        resp.raise_for_status()
+        return resp
+
+
+def gh_graphql_fetch(numbers: List[int]):
+    """Fetch many PRs plus their commits via batched GraphQL and fill the cache.
+
+    Aliased queries replace one REST round-trip per PR plus one per commit
+    list, which is what makes `search`/`crunch` on a cold cache take minutes.
+    Batches of 50 stay well under GitHub's node and query-size limits even
+    when a no-argument `crunch` backfills the whole cache.
+    """
+    for i in range(0, len(numbers), 50):
+        _gh_graphql_fetch_batch(numbers[i:i + 50])
+
+
+def _gh_graphql_fetch_batch(numbers: List[int]):
+    if not numbers:
+        return
+
+    fields = ('number title body merged mergedAt url '
+              'mergeCommit { oid } '
+              'labels(first: 20) { nodes { name } } '
+              'commits(first: 100) { totalCount nodes { commit { oid message } } }')
+    aliased = ' '.join(
+        f'pr{n}: pullRequest(number: {n}) {{ {fields} }}'
+        for n in numbers
+    )
+    query = 'query { repository(owner: "ceph", name: "ceph") { %s } }' % aliased
+    resp = _graphql_post({'query': query})
+    body = resp.json()
+    if body.get('data') is None:
+        # rejected queries (node/size limits, bad syntax) come back as
+        # HTTP 200 with data: null and an errors array
+        raise RuntimeError(f"GraphQL query failed: {body.get('errors')}")
+    repository = body['data']['repository']
+
+    for n in numbers:
+        node = repository.get(f'pr{n}')
+        if node is None:
+            # deleted or inaccessible PR: leave it to the REST fallback
+            continue
+        commits = [c['commit'] for c in node['commits']['nodes']]
+        total_commits = node['commits']['totalCount']
+        if node['mergedAt'] is not None:
+            merged_at = _utc_naive(parser.isoparse(node['mergedAt']))
+        else:
+            merged_at = datetime(1970, 1, 1)
+        pr = CachedPr(node['number'],
+                      total_commits,
+                      node['title'],
+                      node['body'],
+                      node['merged'],
+                      merged_at,
+                      node['url'],
+                      False,
+                      tuple(l['name'] for l in node['labels']['nodes']),
+                      (node['mergeCommit'] or {}).get('oid', ''))
+        pr.save()
+        if len(commits) < total_commits:
+            # first:100 truncated the list and aliased queries cannot page
+            # it; leave the commit list uncached so get_commits falls back
+            # to the paginated REST endpoint
+            continue
+        shas = []
+        for c in commits:
+            tmp = CachedCommit(c['oid'], c['message'], False)
+            CachedCommit(c['oid'], c['message'], tmp._in_current_branch()).save()
+            shas.append(c['oid'])
+        key = pr.merge_commit_sha or str(pr.number)
+        gh_cache.pr_commits[key] = shas
+        gh_cache.save_delta('pr_commits', key, shas)
+
 
 _check_silent = False
 def _check(condition, name, description):
@@ -285,51 +755,81 @@ def get_branch_name(prs: List[CachedPr]) ->  str:
     return f'{base_branch_name}-backport-' + ('-'.join([str(pr.number) for pr in prs]))[:60]
 
 
+def _pull_base_branch():
+    # skip the network round-trip if we fetched upstream within the last
+    # five minutes (e.g. several backports in one sitting)
+    try:
+        fresh = time.time() - os.path.getmtime('.git/FETCH_HEAD') < 300
+    except OSError:
+        fresh = False
+    if fresh:
+        print(f'skipping `git pull upstream {base_branch_name}`: recently fetched')
+        return
+    _git('pull', 'upstream', base_branch_name)
+
+
 def backport_commits(branch_name: str, commits: List[str]):
 
     print(f"git cherry-pick --abort ; git reset --hard HEAD && git checkout {base_branch_name} && git branch -D {branch_name}")
 
-    commits_str = ' '.join(c for c in commits)
-
-    check_call(f"git pull upstream {base_branch_name}", shell=True)
-    check_call(f"git checkout -b {branch_name}", shell=True)
-    check_call(f"git cherry-pick -x {commits_str}", shell=True)
+    _pull_base_branch()
+    _git('checkout', '-b', branch_name)
+    get_current_branch_name.cache_clear()  # HEAD moved
+    _git('cherry-pick', '-x', *commits)
 
 def order_commit_shas(commit_shas: List[str]):
-    out = check_output(f"git rev-list --topo-order {' '.join(commit_shas)}", shell=True)
+    # a real walk is needed here: --no-walk ignores --topo-order and sorts
+    # by commit date only, which scrambles same-second commits (the normal
+    # result of a rebase). --stdin avoids any argv length limit.
+    out = check_output(['git', 'rev-list', '--topo-order', '--stdin'],
+                       input='\n'.join(commit_shas) + '\n', text=True)
     commit_shas_set = set(commit_shas)
-    lines = out.decode().splitlines()
-    ret = [
-        l.strip()
-        for l in lines
-        if l.strip() in commit_shas_set
-    ]
+    ret = [sha for sha in out.split() if sha in commit_shas_set]
     _check(len(ret) != len(commit_shas_set),
            order_commit_shas_non_equal,
-           f'order_commit_shas: dropping commits: {set(commit_shas) - set(ret)}, adding commits: {set(ret) - commit_shas_set}')
+           f'order_commit_shas: dropping commits: {commit_shas_set - set(ret)}, adding commits: {set(ret) - commit_shas_set}')
 
     ret.reverse()
     return ret
 
 def push_backport_branch(branch_name):
-    check_call(f"git push --set-upstream origin {branch_name}", shell=True)
+    _git('push', '--set-upstream', 'origin', branch_name)
+
+
+def _prefetch(prs: List[CachedPr]):
+    # overlap the per-PR commit-list fetches: they are independent REST
+    # round-trips, so the wall clock is max(latency) instead of the sum
+    uncached = [pr for pr in prs if pr._cached_commit_shas() is None]
+    if not uncached:
+        return
+    with ThreadPoolExecutor(max_workers=_jobs) as ex:
+        list(ex.map(lambda pr: pr.get_commits(), uncached))
 
 
 def get_prs(pr_ids: List[str]) -> List[CachedPr]:
     earliest_pr = datetime(2021, 3, 15)
 
-    prs = [CachedPr.from_any(int(pr_id)) for pr_id in pr_ids ]
-    prs = [pr for pr in prs if pr.merged_at > earliest_pr]
+    numbers = [int(pr_id) for pr_id in pr_ids]
+    CachedPr.bulk_fetch(numbers)
 
+    prs = [CachedPr.from_any(n) for n in numbers]
+    # validate before the cutoff filter: an unmerged PR carries the 1970
+    # fallback merged_at and the filter would drop it silently, never giving
+    # check_pr_not_merged (or --ignore-pr-not-merged) a chance to fire
     for pr in prs:
         pr.validate()
+    prs = [pr for pr in prs if pr.merged_at > earliest_pr]
     prs = sorted(prs, key=lambda pr: pr.merged_at)
 
     return prs
 
 
-def create_backport_pull_request(milestone: Milestone,
-                                 prs: List[CachedPr],
+# the issues API takes the milestone number directly; no need to GET the
+# Milestone object first
+backport_milestone = 13
+
+
+def create_backport_pull_request(prs: List[CachedPr],
                                  title):
     numberstr = ', '.join(f'#{pr.number}' for pr in prs)
     body = f"Backport of {numberstr}"
@@ -340,21 +840,30 @@ def create_backport_pull_request(milestone: Milestone,
         base=base_branch_name,
         head=f'sebastian-philipp:{get_branch_name(prs)}',
     )
-    labels = set(sum([pr.get_labels() for pr in prs], []))
-    backport_pr.set_labels(*list(labels))
-    backport_pr.as_issue().edit(milestone=milestone,)
+    labels = set(itertools.chain.from_iterable(pr.get_labels() for pr in prs))
+    # labels and milestone live on the same issue resource: one PATCH
+    # replaces the set_labels + as_issue().edit round-trips
+    _session().patch(
+        f'https://api.github.com/repos/ceph/ceph/issues/{backport_pr.number}',
+        json={'labels': sorted(labels), 'milestone': backport_milestone},
+    ).raise_for_status()
     print(f'Backport PR creted: {backport_pr.html_url}')
 
 
 def backport(pr_ids: List[str]):
+    global _log_index
 
-    prs = get_prs(pr_ids)
+    _warm_git_caches()
+    with gh_cache.batched():
+        prs = get_prs(pr_ids)
+        _prefetch(prs)
+        _log_index = _build_log_index(prs)
 
-    commits: List[CachedCommit] = []
-    for pr in prs:
-        this_commits = pr.get_commits()
-        for c in this_commits:
-            commits.append(c)
+        # materialize once; everything below re-reads this list instead of
+        # re-walking per-PR commit iterators
+        commits: List[CachedCommit] = [
+            c for pr in prs for c in pr.get_commits()
+        ]
 
     for c in commits:
         _check(c.backported, commit_not_merged, f"Commit {c.sha} already in current branch")
@@ -380,15 +889,22 @@ def search_prs_label(g: Github, label: str) -> List[int]:
         'created': '>2021-10-19'
     }
     issues = g.search_issues('', sort='updated', **q)
-    ids = [issue.number for issue in issues[0:80]]
+    # islice stops the PaginatedList after 80 results without the extra
+    # page fetches that slicing by index can trigger
+    ids = [issue.number for issue in itertools.islice(issues, 80)]
     print(f'found for label {label}: {ids}')
     return ids
 
 
 def search_prs(g: Github):
-    ids = set(sum([search_prs_label(g, l) for l in labels], []))
+    g.per_page = 80
+    with ThreadPoolExecutor(max_workers=len(labels)) as ex:
+        ids = set(itertools.chain.from_iterable(
+            ex.map(lambda l: search_prs_label(g, l), labels)))
 
-    prs = [CachedPr.from_any(id) for id in ids]
+    with gh_cache.batched():
+        CachedPr.bulk_fetch(list(ids))
+        prs = [CachedPr.from_any(id) for id in ids]
 
     print(f'found {len(prs)} issues')
 
@@ -405,33 +921,36 @@ def main_create_backport_pr(push: bool,
 
     if push:
         push_backport_branch(get_branch_name(prs))
-    github_milestone: Milestone = ceph_repo().get_milestone(13)
-    create_backport_pull_request(github_milestone,
-                                 prs,
-                                 title)
+    create_backport_pull_request(prs, title)
 
 def crunch(pr_ids: List[str]):
-    global _check_silent
+    global _check_silent, _log_index
     _check_silent = True
 
     if not pr_ids:
         pr_ids = list(gh_cache.prs.keys())
 
-    prs = get_prs(pr_ids)
-    max_n = max(len(str(pr.number)) for pr in prs)
-    max_t = max(len(str(pr.title)) for pr in prs)
-    max_at = max(len(str(pr.merged_at.isoformat())) for pr in prs)
-    f = '{n:<' + str(max_n) + '}  {t:<' + str(max_t) + '} {b:<10} {at:<' + str(max_at) + '}'
-    print(f.format(n='NUM', t='TITLE', b='BACKPORTED', at='MERGED AT'))
-    for pr in prs:
-        print(f.format(n=pr.number, t=pr.title, b=str(pr.get_backported()), at=pr.merged_at.isoformat()))
-
-
+    _warm_git_caches()
+    with gh_cache.batched():
+        prs = get_prs(pr_ids)
+        _prefetch(prs)
+        _log_index = _build_log_index(prs)
+        rows = [('NUM', 'TITLE', 'BACKPORTED', 'MERGED AT')]
+        rows += [
+            (str(pr.number), pr.title, str(pr.get_backported()), pr.merged_at.isoformat())
+            for pr in prs
+        ]
+    widths = [max(len(row[i]) for row in rows) for i in range(4)]
+    # one write instead of one print (and stdout lock) per row
+    sys.stdout.write('\n'.join(
+        '  '.join(col.ljust(w) for col, w in zip(row, widths)).rstrip()
+        for row in rows
+    ) + '\n')
+
+
+@functools.lru_cache(maxsize=1)
 def ceph_repo() -> Repository:
-    global _ceph_repo
-    if _ceph_repo is None:
-        _ceph_repo = g.get_repo('ceph/ceph')
-    return _ceph_repo
+    return g.get_repo('ceph/ceph')
 
 
 if __name__ == '__main__':
@@ -446,6 +965,12 @@ if __name__ == '__main__':
         disabled_checks.add(check_tracker)
     if args['--ignore-order-commit-shas-non-equal']:
         disabled_checks.add(order_commit_shas_non_equal)
+    if args['--force']:
+        _force_recheck = True
+    _jobs = int(args['--jobs'])
+    assert _jobs > 0, '--jobs must be positive'
+    if args['--paranoid']:
+        _paranoid = True
     if args['--label']:
         labels = args['--label'].split(',')
     else:
@@ -454,14 +979,18 @@ if __name__ == '__main__':
 
     gh_cache = GHCache()
 
-    with open(f"{os.environ['HOME']}/.github_token") as f:
-        token = f.read().strip()
+    token = (Path.home() / '.github_token').read_text().strip()
+
+    from github import Github
 
-    g = Github(token)
+    # the default method list excludes POST, so create_pull cannot be
+    # replayed into a duplicate PR
+    g = Github(token, per_page=100,
+               retry=Retry(total=3, backoff_factor=0.3,
+                           status_forcelist=[502, 503, 504]))
     #g = Github(token + 'xxx')
     #g = Github()
 
-    _ceph_repo = None
     if args['search']:
         assert base_branch_name in 'octopus pacific quincy'.split()
 